@@ -0,0 +1,50 @@
+import importlib.util
+from typing import List, Union
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+# The ONNX backend is optional and needs both Optimum and ONNX Runtime;
+# when installed it serves CPU inference
+ONNX_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ("optimum", "onnxruntime"))
+
+
+def load_embedding_model(name: str) -> SentenceTransformer:
+    """Load a sentence-transformers model configured for fast inference.
+
+    On CUDA the model runs in half precision. On CPU the ONNX Runtime backend
+    is used when optimum and onnxruntime are installed and the model can be
+    exported, otherwise the regular PyTorch model.
+
+    Args:
+        name: Name of the sentence-transformers model
+
+    Returns:
+        The loaded model
+    """
+    if torch.cuda.is_available():
+        return SentenceTransformer(name, device="cuda").half()
+
+    if ONNX_AVAILABLE:
+        try:
+            return SentenceTransformer(name, device="cpu", backend="onnx")
+        except Exception as e:
+            print(f"Warning: ONNX backend unavailable for {name}, falling back to PyTorch: {e}")
+
+    return SentenceTransformer(name, device="cpu")
+
+
+def encode(model: SentenceTransformer, sentences: Union[str, List[str]], **kwargs) -> np.ndarray:
+    """Encode sentences with autograd bookkeeping disabled.
+
+    Args:
+        model: Model returned by load_embedding_model
+        sentences: A single sentence or a list of sentences
+        **kwargs: Additional arguments passed to SentenceTransformer.encode
+
+    Returns:
+        Embedding of shape (D,) for a single sentence, or (N, D) for a list
+    """
+    with torch.inference_mode():
+        return model.encode(sentences, **kwargs)
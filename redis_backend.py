@@ -1,30 +1,65 @@
-import json
 import uuid
-from datetime import datetime
-from typing import Dict, List, Optional, Any
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from typing import Dict, List, Optional, Any, Tuple
 
+import numpy as np
+import orjson
 import redis
-from sentence_transformers import SentenceTransformer
+
+from embedding_model import encode, load_embedding_model
+from similarity import decode_embeddings, quantize
+from vector_index import FAISS_AVAILABLE, UserIndexRegistry, UserMatrixCache
+
+# Fields of the hash each memory is stored in, in the order they are read back
+_MEMORY_FIELDS = ("id", "user_id", "messages", "content", "created_at")
+
+# Records which startup migrations have run; kept outside the memory prefix
+# so the migrations' own scans never match it
+_SCHEMA_VERSION_KEY = "schema_version:coding_preference"
+_SCHEMA_VERSION = 2
 
 class RedisMemoryBackend:
     """Redis-based backend for storing and retrieving coding preferences.
     
     This backend uses Redis for storage and sentence-transformers for semantic search.
     It can be used as an alternative to mem0 when you don't have a mem0 account.
+    
+    Stored embeddings are L2-normalized and quantized to int8 at insert time,
+    so cosine similarity reduces to a plain dot product. Search goes through a
+    per-user HNSW index when FAISS is installed, and otherwise scans a per-user
+    in-process matrix of the quantized embeddings; either is loaded from
+    storage on the user's first search.
     """
     
-    def __init__(self, redis_url: str = "redis://localhost:6379/0", embedding_model: str = "all-MiniLM-L6-v2"):
+    def __init__(self, redis_url: str = "redis://localhost:6379/0", embedding_model: str = "all-MiniLM-L6-v2",
+                 index_dir: Optional[str] = None):
         """Initialize the Redis backend.
         
         Args:
             redis_url: Redis connection URL
             embedding_model: Name of the sentence-transformers model to use for embeddings
+            index_dir: Directory to persist search indexes in (None keeps them in memory only)
         """
         self.redis_client = redis.from_url(redis_url)
-        self.model = SentenceTransformer(embedding_model)
+        self.model = load_embedding_model(embedding_model)
+        self.dim = self.model.get_sentence_embedding_dimension()
         self.prefix = "coding_preference:"
         self.embedding_prefix = "embedding:"
         
+        # Use per-user ANN indexes for search when FAISS is available, and
+        # cached per-user embedding matrices otherwise
+        if FAISS_AVAILABLE:
+            # Identify the store without its credentials so that several
+            # deployments can share an index directory
+            url = urlsplit(redis_url)
+            namespace = f"{url.scheme}://{url.hostname}:{url.port}{url.path}?{url.query}#{self.prefix}"
+            self.index = UserIndexRegistry(self.dim, index_dir=index_dir, namespace=namespace)
+        else:
+            self.index = UserMatrixCache()
+        
+        self._migrate()
+        
     def add(self, messages: List[Dict[str, str]], user_id: str = "default_user", **kwargs) -> str:
         """Add a new coding preference to Redis.
         
@@ -36,33 +71,68 @@ class RedisMemoryBackend:
         Returns:
             ID of the stored preference
         """
-        # Generate a unique ID for this preference
-        preference_id = str(uuid.uuid4())
-        key = f"{self.prefix}{user_id}:{preference_id}"
+        return self.add_batch([(messages, user_id)])[0]
+    
+    def add_batch(self, items: List[Tuple[List[Dict[str, str]], str]]) -> List[str]:
+        """Add several coding preferences to Redis at once.
+        
+        All contents are embedded in a single batched forward pass and written
+        in a single pipelined round-trip.
+        
+        Args:
+            items: List of (messages, user_id) tuples
+            
+        Returns:
+            IDs of the stored preferences, in the same order as items
+        """
+        if not items:
+            return []
         
         # Extract content from messages
-        content = "\n".join([msg["content"] for msg in messages])
-        
-        # Create memory object
-        memory = {
-            "id": preference_id,
-            "user_id": user_id,
-            "messages": messages,
-            "content": content,
-            "created_at": datetime.now().isoformat(),
-        }
+        contents = ["\n".join([msg["content"] for msg in messages]) for messages, _ in items]
+        
+        # Generate all embeddings in one batch
+        embeddings = encode(self.model, contents, batch_size=32, convert_to_numpy=True,
+                            normalize_embeddings=True)
         
-        # Store in Redis
-        self.redis_client.set(key, json.dumps(memory))
+        # Read the clock once per batch, then offset each preference by a
+        # microsecond so the batch keeps its insertion order when sorted by
+        # creation time instead of falling back to the random ids
+        now = datetime.now()
+        
+        preference_ids = []
+        pipe = self.redis_client.pipeline()
+        for i, ((messages, user_id), content, embedding) in enumerate(zip(items, contents, embeddings)):
+            created = now + timedelta(microseconds=i)
+            # Generate a unique ID for this preference
+            preference_id = str(uuid.uuid4())
+            preference_ids.append(preference_id)
+            key = f"{self.prefix}{user_id}:{preference_id}"
+            
+            # Store memory as a hash so reads can skip JSON parsing for all
+            # fields but messages, then store its embedding
+            pipe.hset(key, mapping={
+                "id": preference_id,
+                "user_id": user_id,
+                "messages": orjson.dumps(messages),
+                "content": content,
+                "created_at": created.isoformat(),
+            })
+            pipe.set(f"{self.embedding_prefix}{key}", quantize(embedding).tobytes())
+            
+            # Add to user's preferences, ordered by creation time
+            pipe.zadd(f"{self.prefix}{user_id}:ids", {preference_id: created.timestamp()})
         
-        # Generate and store embedding
-        embedding = self.model.encode(content).tolist()
-        self.redis_client.set(f"{self.embedding_prefix}{key}", json.dumps(embedding))
+        pipe.execute()
         
-        # Add to user's list of preferences
-        self.redis_client.sadd(f"{self.prefix}{user_id}:ids", preference_id)
+        # Keep any loaded search indexes in sync
+        positions_by_user: Dict[str, List[int]] = {}
+        for i, (_, user_id) in enumerate(items):
+            positions_by_user.setdefault(user_id, []).append(i)
+        for user_id, positions in positions_by_user.items():
+            self.index.add(user_id, [preference_ids[i] for i in positions], embeddings[positions])
         
-        return preference_id
+        return preference_ids
     
     def get_all(self, user_id: str = "default_user", page: int = 1, page_size: int = 50, **kwargs) -> Dict[str, Any]:
         """Get all coding preferences for a user.
@@ -76,31 +146,26 @@ class RedisMemoryBackend:
         Returns:
             Dictionary with results and pagination info
         """
-        # Get all preference IDs for this user
-        preference_ids = self.redis_client.smembers(f"{self.prefix}{user_id}:ids")
-        preference_ids = sorted(list(preference_ids))  # Sort for consistent ordering
-        
         # Apply pagination
         start_idx = (page - 1) * page_size
         end_idx = start_idx + page_size
-        page_ids = preference_ids[start_idx:end_idx]
         
-        # Fetch all preferences
-        results = []
-        for pid in page_ids:
-            key = f"{self.prefix}{user_id}:{pid.decode('utf-8')}"
-            data = self.redis_client.get(key)
-            if data:
-                memory = json.loads(data)
-                results.append({"memory": memory})
+        # Fetch only this page of preference IDs (most recent first) and the total count
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zrevrange(f"{self.prefix}{user_id}:ids", start_idx, end_idx - 1)
+        pipe.zcard(f"{self.prefix}{user_id}:ids")
+        page_ids, total = pipe.execute()
+        
+        # Fetch the page of preferences in a single round-trip
+        results = self._fetch_memories(user_id, [pid.decode('utf-8') for pid in page_ids])
         
         return {
             "results": results,
             "pagination": {
                 "page": page,
                 "page_size": page_size,
-                "total": len(preference_ids),
-                "total_pages": (len(preference_ids) + page_size - 1) // page_size
+                "total": total,
+                "total_pages": (total + page_size - 1) // page_size
             }
         }
     
@@ -116,44 +181,130 @@ class RedisMemoryBackend:
         Returns:
             Dictionary with search results
         """
-        # Get all preference IDs for this user
-        preference_ids = self.redis_client.smembers(f"{self.prefix}{user_id}:ids")
+        # Skip encoding the query for users without preferences
+        total = self.redis_client.zcard(f"{self.prefix}{user_id}:ids")
         
-        if not preference_ids:
+        if not total:
             return {"results": []}
         
         # Generate query embedding
-        query_embedding = self.model.encode(query).tolist()
+        query_embedding = encode(self.model, query, normalize_embeddings=True)
         
-        # Fetch all preferences and their embeddings
-        results = []
-        for pid in preference_ids:
-            pid_str = pid.decode('utf-8')
-            key = f"{self.prefix}{user_id}:{pid_str}"
-            embedding_key = f"{self.embedding_prefix}{key}"
+        # Rank using only the embeddings held in memory; memory documents (with
+        # their messages) are fetched for the top results alone
+        top_ids = self.index.search(
+            user_id, query_embedding, limit,
+            load=lambda: self._load_embeddings(user_id),
+            stored_ids=lambda: self._stored_ids(user_id),
+        )
+        
+        return {
+            "results": self._fetch_memories(user_id, top_ids)
+        }
+    
+    def _migrate(self) -> None:
+        """Upgrade data written by earlier versions.
+        
+        The applied schema version is stored in Redis, so each keyspace scan
+        runs once rather than on every startup.
+        """
+        version = int(self.redis_client.get(_SCHEMA_VERSION_KEY) or 0)
+        
+        if version < 1:
+            self._migrate_id_sets()
+        if version < 2:
+            self._migrate_memory_strings()
+        
+        if version < _SCHEMA_VERSION:
+            self.redis_client.set(_SCHEMA_VERSION_KEY, _SCHEMA_VERSION)
+    
+    def _migrate_id_sets(self) -> None:
+        """Convert per-user id sets written by earlier versions to sorted sets.
+        
+        Earlier versions kept preference IDs in a plain set; they are rescored
+        by each memory's created_at so pagination can happen server-side.
+        """
+        for ids_key in self.redis_client.scan_iter(match=f"{self.prefix}*:ids", _type="set"):
+            ids_key = ids_key.decode('utf-8')
+            user_key_prefix = ids_key[:-len("ids")]
+            pid_strs = [pid.decode('utf-8') for pid in self.redis_client.smembers(ids_key)]
+            
+            scores = {}
+            if pid_strs:
+                blobs = self.redis_client.mget([f"{user_key_prefix}{pid_str}" for pid_str in pid_strs])
+                for pid_str, data in zip(pid_strs, blobs):
+                    if data:
+                        scores[pid_str] = datetime.fromisoformat(orjson.loads(data)["created_at"]).timestamp()
             
+            # Build the sorted set aside and swap it in atomically
+            tmp_key = f"{ids_key}:migrating"
+            pipe = self.redis_client.pipeline()
+            pipe.delete(tmp_key)
+            if scores:
+                pipe.zadd(tmp_key, scores)
+                pipe.rename(tmp_key, ids_key)
+            else:
+                pipe.delete(ids_key)
+            pipe.execute()
+    
+    def _migrate_memory_strings(self) -> None:
+        """Convert memories stored as JSON strings by earlier versions to hashes."""
+        for key in self.redis_client.scan_iter(match=f"{self.prefix}*", _type="string"):
             data = self.redis_client.get(key)
-            embedding_data = self.redis_client.get(embedding_key)
+            if not data:
+                continue
             
-            if data and embedding_data:
-                memory = json.loads(data)
-                embedding = json.loads(embedding_data)
-                
-                # Calculate similarity (dot product)
-                similarity = sum(a * b for a, b in zip(query_embedding, embedding))
-                
-                results.append({
-                    "memory": memory,
-                    "similarity": similarity
-                })
-        
-        # Sort by similarity (highest first) and limit results
-        results.sort(key=lambda x: x["similarity"], reverse=True)
-        results = results[:limit]
-        
-        # Format results to match mem0 API
-        formatted_results = [{"memory": item["memory"]} for item in results]
+            memory = orjson.loads(data)
+            pipe = self.redis_client.pipeline()
+            pipe.delete(key)
+            pipe.hset(key, mapping={
+                "id": memory["id"],
+                "user_id": memory["user_id"],
+                "messages": orjson.dumps(memory["messages"]),
+                "content": memory["content"],
+                "created_at": memory["created_at"],
+            })
+            pipe.execute()
+    
+    def _stored_ids(self, user_id: str) -> List[str]:
+        """List all preference IDs stored for a user."""
+        return [pid.decode('utf-8') for pid in self.redis_client.zrange(f"{self.prefix}{user_id}:ids", 0, -1)]
+    
+    def _load_embeddings(self, user_id: str) -> Tuple[List[str], np.ndarray]:
+        """Load the stored embeddings for a user as an (N, D) int8 matrix and parallel id list."""
+        pid_strs = self._stored_ids(user_id)
+        emb_keys = [f"{self.embedding_prefix}{self.prefix}{user_id}:{pid_str}" for pid_str in pid_strs]
         
-        return {
-            "results": formatted_results
-        }
\ No newline at end of file
+        ids = []
+        embeddings = []
+        for pid_str, embedding_data in zip(pid_strs, self.redis_client.mget(emb_keys) if emb_keys else []):
+            if embedding_data:
+                ids.append(pid_str)
+                embeddings.append(embedding_data)
+        
+        return ids, decode_embeddings(embeddings, self.dim)
+    
+    def _fetch_memories(self, user_id: str, preference_ids: List[str]) -> List[Dict[str, Any]]:
+        """Fetch memories by id in a single round-trip, formatted like mem0 results and kept in order."""
+        if not preference_ids:
+            return []
+        
+        pipe = self.redis_client.pipeline(transaction=False)
+        for pid_str in preference_ids:
+            pipe.hmget(f"{self.prefix}{user_id}:{pid_str}", _MEMORY_FIELDS)
+        
+        results = []
+        for pid, user, messages, content, created_at in pipe.execute():
+            if pid is None:
+                continue
+            
+            # Only messages holds JSON; every other field is a plain string
+            memory = {
+                "id": pid.decode('utf-8'),
+                "user_id": user.decode('utf-8'),
+                "messages": orjson.loads(messages),
+                "content": content.decode('utf-8'),
+                "created_at": created_at.decode('utf-8'),
+            }
+            results.append({"memory": memory})
+        return results
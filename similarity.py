@@ -0,0 +1,120 @@
+from typing import List
+
+import numpy as np
+import orjson
+
+from _cos_kernel import NUMBA_AVAILABLE
+
+# Try to import SimSIMD for hardware-accelerated distance kernels
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+
+if NUMBA_AVAILABLE:
+    from _cos_kernel import cosine_batch
+
+
+def quantize(embeddings: np.ndarray) -> np.ndarray:
+    """Quantize L2-normalized embeddings to int8.
+
+    Each component in [-1, 1] is scaled to [-127, 127], making vectors 4x smaller
+    than float32. On MiniLM embeddings this costs roughly 0.5% recall.
+
+    Args:
+        embeddings: Normalized embeddings of shape (D,) or (N, D)
+
+    Returns:
+        int8 array with the same shape as embeddings
+    """
+    return np.clip(np.round(embeddings * 127), -127, 127).astype(np.int8)
+
+
+def decode_embeddings(blobs: List[bytes], dim: int) -> np.ndarray:
+    """Decode stored embedding bytes into a single (N, D) int8 matrix.
+
+    Embeddings stored before quantization was introduced are either raw
+    float32 (4 * D bytes) or, for the oldest Redis data, a JSON list of floats;
+    those are normalized and quantized on the fly.
+
+    Args:
+        blobs: Stored embedding bytes, one entry per embedding
+        dim: Dimension of the embeddings
+
+    Returns:
+        int8 matrix of shape (len(blobs), dim)
+    """
+    if all(len(blob) == dim for blob in blobs):
+        return np.frombuffer(b"".join(blobs), dtype=np.int8).reshape(len(blobs), dim)
+
+    matrix = np.empty((len(blobs), dim), dtype=np.int8)
+    legacy_rows = []
+    for i, blob in enumerate(blobs):
+        if len(blob) == dim:
+            matrix[i] = np.frombuffer(blob, dtype=np.int8)
+        else:
+            legacy_rows.append(i)
+
+    # Normalize all legacy rows at once rather than one norm per row
+    legacy = np.empty((len(legacy_rows), dim), dtype=np.float32)
+    for j, i in enumerate(legacy_rows):
+        legacy[j] = _decode_legacy_embedding(blobs[i])
+    matrix[legacy_rows] = quantize(legacy / np.linalg.norm(legacy, axis=1, keepdims=True))
+    return matrix
+
+
+def _decode_legacy_embedding(blob: bytes) -> np.ndarray:
+    # A normalized float32 vector can never end in b"]" (0x5D would be the
+    # high exponent byte of a value around 2**59), so brackets mean JSON
+    if blob[:1] == b"[" and blob[-1:] == b"]":
+        return np.asarray(orjson.loads(blob), dtype=np.float32)
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+def dot_similarities(query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Compute the dot product between a query vector and every row of a matrix.
+
+    Both the query and the rows are expected to be L2-normalized (or int8
+    quantized from normalized vectors), in which case the dot product ranks
+    like the cosine similarity. Uses SimSIMD's SIMD kernels when available,
+    then a Numba JIT kernel, and falls back to NumPy otherwise.
+
+    Args:
+        query: Normalized query embedding of shape (D,), same dtype as matrix
+        matrix: Stacked normalized embeddings of shape (N, D)
+
+    Returns:
+        Array of shape (N,) with one similarity per row of the matrix
+    """
+    query = np.ascontiguousarray(query)
+    matrix = np.ascontiguousarray(matrix)
+
+    if SIMSIMD_AVAILABLE:
+        return np.asarray(simsimd.cdist(query[None, :], matrix, metric="dot"))[0]
+
+    if NUMBA_AVAILABLE:
+        return cosine_batch(query, matrix)
+
+    # NumPy has no BLAS path for int8, so widen to float32 before the matmul
+    return matrix.astype(np.float32, copy=False) @ query.astype(np.float32, copy=False)
+
+
+def top_k_indices(similarities: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the k highest similarities, best first.
+
+    Uses a partial selection so only the selected k entries are sorted.
+
+    Args:
+        similarities: Array of shape (N,) with one similarity per candidate
+        k: Number of indices to return
+
+    Returns:
+        Array of at most k indices into similarities, ordered by descending similarity
+    """
+    k = min(k, similarities.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    top = np.argpartition(-similarities, k - 1)[:k]
+    return top[np.argsort(-similarities[top])]
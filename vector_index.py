@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from similarity import dot_similarities, quantize, top_k_indices
+
+# Try to import FAISS for approximate nearest neighbour search
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+
+class _UserEntry:
+    """A user's loaded search structure and the preference IDs it covers."""
+
+    def __init__(self, data, ids: List[str], stored_ids: Optional[List[str]] = None):
+        self.data = data
+        self.ids = list(ids)
+        # Also count stored ids that had no embedding to load, so they are
+        # not mistaken for changes in storage
+        self.known_ids = set(self.ids).union(stored_ids or ())
+        self.checked_at = time.monotonic()
+
+    def unseen(self, ids: List[str]) -> List[int]:
+        """Return the positions of ids this entry does not cover yet."""
+        return [i for i, pid in enumerate(ids) if pid not in self.known_ids]
+
+    def extend(self, ids: List[str]) -> None:
+        """Record ids whose embeddings were just added to the structure."""
+        self.ids.extend(ids)
+        self.known_ids.update(ids)
+
+
+class _UserEntries:
+    """Shared bookkeeping for per-user search structures.
+
+    Entries are kept up to date by add(), but changes made by other processes
+    are only noticed by comparing the ids an entry covers with the ids in
+    storage. That check runs at most once every stale_after seconds per user,
+    outside the lock.
+    """
+
+    def __init__(self, stale_after: float):
+        self.stale_after = stale_after
+        self._entries: Dict[str, _UserEntry] = {}
+        self._lock = threading.Lock()
+
+    def _drop_if_stale(self, user_id: str, stored_ids: Callable[[], List[str]]) -> None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or time.monotonic() - entry.checked_at < self.stale_after:
+            return
+
+        stored = set(stored_ids())
+        with self._lock:
+            if entry.known_ids == stored:
+                entry.checked_at = time.monotonic()
+            elif self._entries.get(user_id) is entry:
+                del self._entries[user_id]
+
+
+class UserIndexRegistry(_UserEntries):
+    """Per-user FAISS HNSW indexes over int8-quantized embeddings.
+
+    The graph stores the same int8 codes as storage (8-bit direct scalar
+    quantization), so search scans a quarter of the float32 bytes and an index
+    built from storage ranks exactly like one kept up to date by add().
+
+    Indexes are built lazily on a user's first search by streaming their stored
+    embeddings, and kept up to date in-process as new preferences are added.
+    When an index directory is configured, each freshly built index is persisted
+    next to its id map so it can be reloaded after a restart instead of rebuilt;
+    a persisted index whose ids no longer match storage is rebuilt.
+    """
+
+    def __init__(self, dim: int, index_dir: Optional[str] = None, namespace: str = "",
+                 hnsw_m: int = 32, ef_search: int = 64, stale_after: float = 30.0):
+        """Initialize the registry.
+
+        Args:
+            dim: Dimension of the embeddings
+            index_dir: Directory to persist indexes in (None disables persistence)
+            namespace: Identifies the backing store, so stores sharing index_dir don't collide
+            hnsw_m: Number of neighbours per node in the HNSW graph
+            ef_search: Size of the HNSW candidate list at query time
+            stale_after: Seconds between checks of an index against storage
+        """
+        if not FAISS_AVAILABLE:
+            raise ImportError("FAISS is not installed. Run 'pip install faiss-cpu'")
+
+        super().__init__(stale_after)
+        self.dim = dim
+        self.index_dir = index_dir
+        self.namespace = namespace
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+
+    def search(self, user_id: str, query: np.ndarray, k: int,
+               load: Callable[[], Tuple[List[str], np.ndarray]],
+               stored_ids: Callable[[], List[str]]) -> List[str]:
+        """Find the preferences closest to a query embedding.
+
+        Args:
+            user_id: User identifier
+            query: Normalized query embedding of shape (D,)
+            k: Maximum number of ids to return
+            load: Callable returning (ids, (N, D) int8 matrix) of the user's stored embeddings
+            stored_ids: Callable returning the IDs of the embeddings currently stored for the user
+
+        Returns:
+            Preference IDs ordered by descending similarity
+        """
+        self._drop_if_stale(user_id, stored_ids)
+
+        with self._lock:
+            entry = self._get_or_build(user_id, load, stored_ids)
+            k = min(k, entry.data.ntotal)
+            if k <= 0:
+                return []
+
+            _, labels = entry.data.search(np.ascontiguousarray(query[None, :], dtype=np.float32), k)
+            ids = entry.ids
+
+        return [ids[i] for i in labels[0] if i >= 0]
+
+    def add(self, user_id: str, ids: List[str], embeddings: np.ndarray) -> None:
+        """Add newly stored embeddings to a user's index.
+
+        Users whose index has not been built yet are skipped; their index will
+        include these embeddings when it is built from storage. IDs the index
+        already covers are skipped too, since an index built between storing
+        the embeddings and this call already contains them.
+
+        Args:
+            user_id: User identifier
+            ids: Preference IDs, one per row of embeddings
+            embeddings: Normalized embeddings of shape (N, D)
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+
+            rows = entry.unseen(ids)
+            if not rows:
+                return
+
+            entry.data.add(quantize(embeddings[rows]).astype(np.float32))
+            entry.extend([ids[i] for i in rows])
+
+    def _get_or_build(self, user_id: str, load: Callable[[], Tuple[List[str], np.ndarray]],
+                      stored_ids: Callable[[], List[str]]) -> _UserEntry:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            return entry
+
+        # Reuse a persisted index only if it covers exactly the stored embeddings
+        stored = stored_ids()
+        entry = self._load(user_id)
+        if entry is None or entry.known_ids != set(stored):
+            ids, matrix = load()
+            index = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_8bit_direct_signed,
+                                      self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            if ids:
+                index.add(matrix.astype(np.float32))
+            entry = _UserEntry(index, ids, stored)
+            self._save(user_id, entry)
+
+        entry.data.hnsw.efSearch = self.ef_search
+        self._entries[user_id] = entry
+        return entry
+
+    def _paths(self, user_id: str) -> Tuple[str, str]:
+        # Hash the store and user id so arbitrary ids map to safe file names
+        name = hashlib.sha1(f"{self.namespace}\0{user_id}".encode("utf-8")).hexdigest()
+        base = os.path.join(self.index_dir, name)
+        return f"{base}.faiss", f"{base}.ids.json"
+
+    def _load(self, user_id: str) -> Optional[_UserEntry]:
+        if not self.index_dir:
+            return None
+
+        index_path, ids_path = self._paths(user_id)
+        if not (os.path.exists(index_path) and os.path.exists(ids_path)):
+            return None
+
+        # Treat unreadable, truncated or mismatched files as missing so the
+        # index is rebuilt from storage
+        try:
+            with open(index_path, "rb") as f:
+                data = f.read()
+            with open(ids_path, "rb") as f:
+                meta = json.load(f)
+            if meta["sha1"] != hashlib.sha1(data).hexdigest():
+                return None
+            index = faiss.deserialize_index(np.frombuffer(data, dtype=np.uint8))
+        except (OSError, ValueError, KeyError, TypeError, RuntimeError):
+            return None
+
+        if index.ntotal != len(meta["ids"]):
+            return None
+        return _UserEntry(index, meta["ids"])
+
+    def _save(self, user_id: str, entry: _UserEntry) -> None:
+        if not self.index_dir:
+            return
+
+        # The id file records a digest of the index file so a pair left
+        # half-replaced by a crash is detected on load
+        data = faiss.serialize_index(entry.data).tobytes()
+        meta = {"ids": entry.ids, "sha1": hashlib.sha1(data).hexdigest()}
+
+        index_path, ids_path = self._paths(user_id)
+        _write_atomic(index_path, data)
+        _write_atomic(ids_path, json.dumps(meta).encode("utf-8"))
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Write next to the target and rename over it, so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class UserMatrixCache(_UserEntries):
+    """Per-user in-process matrices of quantized embeddings for exact search.
+
+    Each user's embeddings are loaded once into a contiguous (N, D) int8 matrix
+    with a parallel id list, so searches scan RAM instead of re-reading every
+    embedding from storage. Used when FAISS is not installed.
+    """
+
+    def __init__(self, stale_after: float = 30.0):
+        """Initialize an empty cache.
+
+        Args:
+            stale_after: Seconds between checks of a cached matrix against storage
+        """
+        super().__init__(stale_after)
+
+    def search(self, user_id: str, query: np.ndarray, k: int,
+               load: Callable[[], Tuple[List[str], np.ndarray]],
+               stored_ids: Callable[[], List[str]]) -> List[str]:
+        """Find the preferences closest to a query embedding.
+
+        Args:
+            user_id: User identifier
+            query: Normalized query embedding of shape (D,)
+            k: Maximum number of ids to return
+            load: Callable returning (ids, (N, D) int8 matrix) of the user's stored embeddings
+            stored_ids: Callable returning the IDs of the embeddings currently stored for the user
+
+        Returns:
+            Preference IDs ordered by descending similarity
+        """
+        # Reload when embeddings were stored by another process
+        self._drop_if_stale(user_id, stored_ids)
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                stored = stored_ids()
+                ids, matrix = load()
+                entry = _UserEntry(np.ascontiguousarray(matrix), ids, stored)
+                self._entries[user_id] = entry
+            matrix, ids = entry.data, entry.ids
+
+        if not len(matrix):
+            return []
+
+        similarities = dot_similarities(quantize(query), matrix)
+        return [ids[i] for i in top_k_indices(similarities, k)]
+
+    def add(self, user_id: str, ids: List[str], embeddings: np.ndarray) -> None:
+        """Append newly stored embeddings to a user's cached matrix.
+
+        Users who are not cached are skipped; they are loaded from storage on
+        their next search. IDs the matrix already holds are skipped too, since
+        a load between storing the embeddings and this call already read them.
+
+        Args:
+            user_id: User identifier
+            ids: Preference IDs, one per row of embeddings
+            embeddings: Normalized embeddings of shape (N, D)
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+
+            rows = entry.unseen(ids)
+            if not rows:
+                return
+
+            entry.data = np.vstack([entry.data, quantize(embeddings[rows])])
+            entry.extend([ids[i] for i in rows])